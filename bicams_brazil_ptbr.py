@@ -1,25 +1,18 @@
-import os
+import io
+import math
+import bisect
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.stats import norm
 import streamlit as st
 from datetime import datetime
-from fpdf import FPDF
-import tempfile
-
-# Map English month names to Portuguese month names
-months_pt = {
-    "January": "Janeiro", "February": "Fevereiro", "March": "Março",
-    "April": "Abril", "May": "Maio", "June": "Junho",
-    "July": "Julho", "August": "Agosto", "September": "Setembro",
-    "October": "Outubro", "November": "Novembro", "December": "Dezembro"
-}
+
+# Portuguese month names, indexed by month number - 1
+months_pt = (
+    "Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
+    "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"
+)
 
 def format_date(date):
-    day = date.strftime("%-d")
-    month = months_pt[date.strftime("%B")]
-    year = date.strftime("%Y")
-    return f"{day} {month} {year}"
+    return f"{date.day} {months_pt[date.month - 1]} {date.year}"
 
 # Define regression model coefficients and residual standard deviations for BICAMS measures
 regression_models = {
@@ -37,6 +30,9 @@ regression_models = {
     }
 }
 
+measures = tuple(regression_models)
+measure_index = {measure: i for i, measure in enumerate(measures)}
+
 conversion_table = {
     'CVLT_totaldeacertos': {
         1: (-np.inf, 19), 2: (20, 28), 3: (29, 31), 4: (32, 35), 5: (36, 39), 6: (40, 41),
@@ -55,49 +51,96 @@ conversion_table = {
     }
 }
 
+# Highest raw score each test allows
+max_raw_scores = {'CVLT_totaldeacertos': 80, 'BVMT_Total': 36, 'SDMT': 120}
+
+# Test inputs in display order: (measure, name with abbreviation, widget key prefix, score label, default score)
+measure_inputs = (
+    ('SDMT', "Symbol Digit Modalities Test (SDMT)", "sdmt", "Pontuação SDMT", 60),
+    ('CVLT_totaldeacertos', "California Verbal Learning Test - Second Edition (CVLT-II)", "cvlt", "Pontuação Total CVLT", 50),
+    ('BVMT_Total', "Brief Visuospatial Memory Test - Revised (BVMT-R)", "bvmt", "Pontuação Total BVMT", 20)
+)
+
+# Expand the conversion table into a dense lookup table indexed by raw score: the bins are
+# contiguous, so each raw score belongs to the first bin whose upper bound it does not exceed
+def build_scaled_score_lut(table, max_raw):
+    highs = np.array([high for _, high in table.values()])
+    scaled_scores = np.array(list(table.keys()), dtype=np.int8)
+    return scaled_scores[np.searchsorted(highs, np.arange(max_raw + 1), side='left')]
+
+# Standard normal density
+def normal_pdf(x):
+    return np.exp(-0.5 * x * x) / np.sqrt(2 * np.pi)
+
+# Coefficient matrix (one row per measure) for vectorized evaluation:
+# columns are constant, age, age2, sex, education and residual_sd
+model_coefficients = np.array([
+    [model['constant'], model['age'], model['age2'], model['sex'], model['education'], model['residual_sd']]
+    for model in regression_models.values()
+])
+
+scaled_score_lut = {
+    measure: build_scaled_score_lut(table, max_raw_scores[measure])
+    for measure, table in conversion_table.items()
+}
+
+# Normal density curve shared by every plot
+pdf_x = np.linspace(-4, 4, 100)
+pdf_y = normal_pdf(pdf_x)
+
 # Function to convert raw scores into scaled scores
 def convert_to_scaled_score(raw_score, measure):
-    for scaled_score, (low, high) in conversion_table[measure].items():
-        if low <= raw_score <= high:
-            return scaled_score
-    return np.nan
-
-# Function to calculate predicted scaled scores
-def calculate_predicted_scaled_score(age, sex, education, measure):
-    model = regression_models[measure]
-    age2 = age ** 2
+    lut = scaled_score_lut[measure]
+    return int(lut[raw_score]) if 0 <= raw_score < len(lut) else np.nan
+
+# Standard normal cumulative distribution function
+def normal_cdf(z):
+    return 0.5 * (1.0 + math.erf(z / math.sqrt(2)))
+
+# Function to calculate the z-score and percentile of a raw score; raw scores without a scaled
+# score give NaN (cached, so reruns that leave the score and demographics unchanged skip the computation)
+@st.cache_data(show_spinner=False, max_entries=256)
+def calculate_z_score(raw_score, measure, age, sex, education):
+    scaled_score = convert_to_scaled_score(raw_score, measure)
+    constant, age_coef, age2_coef, sex_coef, education_coef, residual_sd = \
+        model_coefficients[measure_index[measure]].tolist()
     sex_for_model = 1 if sex == 'M' else 2
-    pss = (model['constant'] + model['age'] * age + model['age2'] * age2 +
-           model['sex'] * sex_for_model + model['education'] * education)
-    return pss
+    pss = (constant + age_coef * age + age2_coef * age ** 2 +
+           sex_coef * sex_for_model + education_coef * education)
+    z_score = (scaled_score - pss) / residual_sd
+    return z_score, normal_cdf(z_score) * 100
+
+# Percentile cut-offs and the classification for each band, from lowest to highest
+percentile_edges = (2, 9, 25, 75, 90, 98)
+percentile_classes = [
+    ("<70", "<2", "Excepcionalmente Baixo", "Exceptionally Low", "#FF0000"),  # Red
+    ("70-79", "2-8", "Abaixo da Média", "Below Average", "#FF4500"),  # Orange
+    ("80-89", "9-24", "Médio-Baixo", "Low Average", "#FFD700"),  # Yellow
+    ("90-109", "25-74", "Médio", "Average", "#00FF00"),  # Green
+    ("110-119", "75-90", "Médio-Alto", "High Average", "#00FFFF"),  # Light Blue
+    ("120-129", "91-97", "Acima da Média", "Above Average", "#0000FF"),  # Blue
+    (">130", ">98", "Excepcionalmente Alto", "Exceptionally High", "#00008B")  # Dark Blue
+]
 
 # Function to interpret percentile and return classification with color
 def interpret_percentile(percentile):
-    if percentile >= 98:
-        return ">130", ">98", "Excepcionalmente Alto", "Exceptionally High", "#00008B"  # Dark Blue
-    elif 90 <= percentile < 98:
-        return "120-129", "91-97", "Acima da Média", "Above Average", "#0000FF"  # Blue
-    elif 75 <= percentile < 90:
-        return "110-119", "75-90", "Médio-Alto", "High Average", "#00FFFF"  # Light Blue
-    elif 25 <= percentile < 75:
-        return "90-109", "25-74", "Médio", "Average", "#00FF00"  # Green
-    elif 9 <= percentile < 25:
-        return "80-89", "9-24", "Médio-Baixo", "Low Average", "#FFD700"  # Yellow
-    elif 2 <= percentile < 9:
-        return "70-79", "2-8", "Abaixo da Média", "Below Average", "#FF4500"  # Orange
-    else:
-        return "<70", "<2", "Excepcionalmente Baixo", "Exceptionally Low", "#FF0000"  # Red
+    return percentile_classes[bisect.bisect_right(percentile_edges, percentile)]
 
-# Plot function with color passed as a parameter
-def plot_normal_distribution(z_score, measure, measure_name, percentile, interpretation, color):
-    # Set the figure size for uniformity
-    fig, ax = plt.subplots(figsize=(8, 3), dpi=100)
+# Plot function with color passed as a parameter; only called from the cached renderers below,
+# so a figure is drawn only when a result is not cached yet
+def plot_normal_distribution(z_score, measure_name, percentile, interpretation, color, figsize=(8, 3)):
+    # Imported here so matplotlib is only loaded once a result has to be plotted
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-    x = np.linspace(-4, 4, 100)
-    y = norm.pdf(x)
-    ax.plot(x, y, zorder=1)
+    # Set the figure size for uniformity; build it outside pyplot so it is not tracked by its global figure manager
+    fig = Figure(figsize=figsize, dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
 
-    ax.scatter([z_score], [norm.pdf(z_score)], color=color, edgecolor='black', linewidth=1.5,
+    ax.plot(pdf_x, pdf_y, zorder=1)
+
+    ax.scatter([z_score], [normal_pdf(z_score)], color=color, edgecolor='black', linewidth=1.5,
                label=f"Z-score = {z_score:.2f}\nPercentil = {percentile:.1f}%\n{interpretation}", s=100, zorder=2)
 
     ax.legend()
@@ -111,8 +154,22 @@ def plot_normal_distribution(z_score, measure, measure_name, percentile, interpr
 
     return fig
 
-# Function to save the report as a PDF
+# Function to render the plot as PNG bytes for display
+# (cached, so unchanged measures are not re-rendered on every rerun as st.pyplot would)
+@st.cache_data(show_spinner=False, max_entries=256)
+def render_plot_png(z_score, measure_name, percentile, interpretation, color):
+    fig = plot_normal_distribution(z_score, measure_name, percentile, interpretation, color)
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=200, bbox_inches="tight")  # Same output as st.pyplot
+    return buf.getvalue()
+
+# Function to save the report as a PDF (cached on the report contents, so repeated downloads
+# with unchanged inputs reuse the bytes)
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
 def save_report_as_pdf(report_data, patient_name, sex, age, education, test_date):
+    # Imported here so fpdf is only loaded when a report is actually requested
+    from fpdf import FPDF
+
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=10)
     pdf.add_page()
@@ -121,7 +178,7 @@ def save_report_as_pdf(report_data, patient_name, sex, age, education, test_date
     pdf.set_font("Arial", "B", 12)
     pdf.multi_cell(190, 8, txt="Avaliação Cognitiva e Interpretação Normativa\n"
                                "BICAMS - Bateria Internacional Breve de Avaliação Cognitiva para Esclerose Múltipla", 
-                  align="C")
+                  align="C", new_x="LMARGIN", new_y="NEXT")
 
     # Add a line space before "Nome"
     pdf.cell(190, 8, txt="", ln=True)
@@ -132,10 +189,13 @@ def save_report_as_pdf(report_data, patient_name, sex, age, education, test_date
                    f"Escolaridade: {education} anos   |   Data do Teste: {formatted_date}")
     
     # Centralize the header text
-    pdf.multi_cell(190, 6, txt=header_text, align="C")
+    pdf.multi_cell(190, 6, txt=header_text, align="C", new_x="LMARGIN", new_y="NEXT")
+
+    # One image buffer reused for every figure (fpdf reads the image data when it is added)
+    buf = io.BytesIO()
 
     for data in report_data:
-        measure, z_score, percentile, fig, score_label = data
+        measure, z_score, percentile, score_label, color = data
 
         # Add a line space before each test
         pdf.cell(190, 8, txt="", ln=True)
@@ -145,19 +205,21 @@ def save_report_as_pdf(report_data, patient_name, sex, age, education, test_date
         pdf.set_font("Arial", size=10)
         pdf.cell(190, 6, txt=f"Z-score: {z_score:.2f} | Percentil: {percentile:.1f}% | Classificação: {score_label}", ln=True, align="C")
         
-        # Save figure to a temporary file with consistent size and centered alignment
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmpfile:
-            fig.set_size_inches(7.5, 2.5)  # Adjust the figure size for better fit and centering
-            fig.savefig(tmpfile.name, format="png", dpi=100)
-            pdf.image(tmpfile.name, x=pdf.w / 2 - 75, y=None, w=150)  # Center the image horizontally using width
-            os.unlink(tmpfile.name)  # Remove the temporary file after use
+        # Render figure to an in-memory JPEG (embedded by fpdf as-is, without re-encoding) at a 3:1
+        # size so three tests and the citation fit on one page; 72 dpi gives ~90 dpi at 150 mm wide
+        fig = plot_normal_distribution(z_score, measure, percentile, score_label, color, figsize=(7.5, 2.5))
+        buf.seek(0)
+        buf.truncate()
+        fig.savefig(buf, format="jpeg", dpi=72, pil_kwargs={"quality": 85, "optimize": True})
+        buf.seek(0)
+        pdf.image(buf, x=pdf.w / 2 - 75, y=None, w=150)  # Center the image horizontally using width
 
     # Add a line space before "Conversão normativa..."
     pdf.cell(190, 8, txt="", ln=True)
 
     # Centralize the citation text block
     pdf.set_font("Arial", "I", size=8)
-    pdf.multi_cell(190, 4, txt="Conversão normativa utilizando a *Calculadora Normativa do BICAMS para a População Brasileira*, desenvolvida por Jonadab dos Santos Silva.", align="C")
+    pdf.multi_cell(190, 4, txt="Conversão normativa utilizando a *Calculadora Normativa do BICAMS para a População Brasileira*, desenvolvida por Jonadab dos Santos Silva.", align="C", new_x="LMARGIN", new_y="NEXT")
     
     # Use cell for the hyperlink to avoid issues with multi_cell
     pdf.set_text_color(0, 0, 255)
@@ -167,14 +229,61 @@ def save_report_as_pdf(report_data, patient_name, sex, age, education, test_date
     
     # Continue with multi_cell for the remaining text
     pdf.set_font("Arial", "I", size=8)
-    pdf.multi_cell(190, 4, txt="Fonte dos dados normativos: Spedo CT, Pereira DA, Frndak SE, Marques VD, Barreira AA, Smerbeck A, Silva PHRD, Benedict RHB. Brief International Cognitive Assessment for Multiple Sclerosis (BICAMS): discrete and regression-based norms for the Brazilian context. Arq Neuropsiquiatr. 2022 Jan;80(1):62-68. doi: 10.1590/0004-282X-ANP-2020-0526.", align="C")
+    pdf.multi_cell(190, 4, txt="Fonte dos dados normativos: Spedo CT, Pereira DA, Frndak SE, Marques VD, Barreira AA, Smerbeck A, Silva PHRD, Benedict RHB. Brief International Cognitive Assessment for Multiple Sclerosis (BICAMS): discrete and regression-based norms for the Brazilian context. Arq Neuropsiquiatr. 2022 Jan;80(1):62-68. doi: 10.1590/0004-282X-ANP-2020-0526.", align="C", new_x="LMARGIN", new_y="NEXT")
     
     file_name = f"{patient_name.replace(' ', '_')}_BICAMS_Report_{test_date.strftime('%Y-%m-%d')}.pdf"
     
-    # Save PDF to a temporary file
-    temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    pdf.output(temp_pdf.name)
-    return temp_pdf.name, file_name
+    # Return the PDF contents directly instead of writing a temporary file
+    return bytes(pdf.output()), file_name
+
+# Function to render one test's inputs and result; returns the report entry (the plot arguments,
+# so the figure is only drawn on a cache miss), or None when the test has no result
+def render_measure(measure, name, key, score_label, default_score, age, sex, education):
+    st.write("---")  # Add a line before each test
+    st.write(f"### {name}")
+    not_applicable = st.checkbox("Não se aplica", key=f"{key}_na")
+    if not_applicable:
+        return None
+
+    input_method = st.radio("Como deseja inserir a pontuação?", ["Deslizar", "Digite"], key=f"{key}_input")
+    max_score = max_raw_scores[measure]
+    if input_method == "Deslizar":
+        raw = st.slider(score_label, min_value=0, max_value=max_score, value=default_score, step=1)
+    else:
+        raw = st.number_input(score_label, min_value=0, max_value=max_score, value=default_score, step=1)
+
+    if raw is None:
+        return None
+
+    z_score, percentile = calculate_z_score(raw, measure, age, sex, education)
+    if math.isnan(z_score):  # Raw score outside the conversion table
+        return None
+    _, _, classification, _, color = interpret_percentile(percentile)
+
+    st.write(f"**{name}**")
+    st.write(f"Z-score: {z_score:.2f}")
+    st.write(f"Percentil: {percentile:.1f}%")
+    st.write(f"Classificação: {classification}")
+
+    st.image(render_plot_png(z_score, name, percentile, classification, color))
+
+    return (name, z_score, percentile, classification, color)
+
+# Function to render one test as a fragment: interacting with its widgets reruns only this section
+# rather than the whole page. The report entry is kept in session state so the PDF export sees
+# every section
+@st.fragment
+def render_measure_section(measure, name, key, score_label, default_score, age, sex, education):
+    result = render_measure(measure, name, key, score_label, default_score, age, sex, education)
+
+    result_key = f"{key}_result"
+    changed = st.session_state.get(result_key) != result
+    st.session_state[result_key] = result
+
+    # The report controls live outside the fragment, so a download button from an earlier full run
+    # would keep offering the old report; rerun the whole page so it reflects the new result
+    if changed and st.session_state.get("report_shown"):
+        st.rerun(scope="app")
 
 
 def main():
@@ -187,112 +296,21 @@ def main():
     education = st.slider("Escolaridade em anos", min_value=1, max_value=20, value=12, step=1)
     test_date = st.date_input("Data do Teste", value=datetime.today())
 
-    # Initialize the z_scores list
-    z_scores = []  # Add this line to initialize z_scores as an empty list
-    report_data = []
-
-    # Test names with abbreviations
-    cvlt_name = "California Verbal Learning Test - Second Edition (CVLT-II)"
-    bvmt_name = "Brief Visuospatial Memory Test - Revised (BVMT-R)"
-    sdmt_name = "Symbol Digit Modalities Test (SDMT)"
-
-    # Process SDMT
-    st.write("---")  # Add a line before each test
-    st.write(f"### {sdmt_name}")
-    sdmt_not_applicable = st.checkbox("Não se aplica", key="sdmt_na")
-    if not sdmt_not_applicable:
-        sdmt_input_method = st.radio("Como deseja inserir a pontuação?", ["Deslizar", "Digite"], key="sdmt_input")
-        if sdmt_input_method == "Deslizar":
-            sdmt_raw = st.slider("Pontuação SDMT", min_value=0, max_value=120, value=60, step=1)
-        else:
-            sdmt_raw = st.number_input("Pontuação SDMT", min_value=0, max_value=120, value=60, step=1)
-
-        if sdmt_raw is not None:
-            sdmt_scaled = convert_to_scaled_score(sdmt_raw, 'SDMT')
-            if not np.isnan(sdmt_scaled):
-                sdmt_pss = calculate_predicted_scaled_score(age, sex, education, 'SDMT')
-                sdmt_z = (sdmt_scaled - sdmt_pss) / regression_models['SDMT']['residual_sd']
-                percentile = norm.cdf(sdmt_z) * 100
-                _, _, classification, _, color = interpret_percentile(percentile)
-                
-                st.write(f"**{sdmt_name}**")
-                st.write(f"Z-score: {sdmt_z:.2f}")
-                st.write(f"Percentil: {percentile:.1f}%")
-                st.write(f"Classificação: {classification}")
-    
-                fig_sdmt = plot_normal_distribution(sdmt_z, 'SDMT', sdmt_name, percentile, classification, color)
-                st.pyplot(fig_sdmt)
-    
-                z_scores.append(sdmt_z)
-                report_data.append((sdmt_name, sdmt_z, percentile, fig_sdmt, classification))
-
-    # Process CVLT
-    st.write("---")  # Add a line before each test
-    st.write(f"### {cvlt_name}")
-    cvlt_not_applicable = st.checkbox("Não se aplica", key="cvlt_na")
-    if not cvlt_not_applicable:
-        cvlt_input_method = st.radio("Como deseja inserir a pontuação?", ["Deslizar", "Digite"], key="cvlt_input")
-        if cvlt_input_method == "Deslizar":
-            cvlt_raw = st.slider("Pontuação Total CVLT", min_value=0, max_value=80, value=50, step=1)
-        else:
-            cvlt_raw = st.number_input("Pontuação Total CVLT", min_value=0, max_value=80, value=50, step=1)
-
-        if cvlt_raw is not None:
-            cvlt_scaled = convert_to_scaled_score(cvlt_raw, 'CVLT_totaldeacertos')
-            if not np.isnan(cvlt_scaled):
-                cvlt_pss = calculate_predicted_scaled_score(age, sex, education, 'CVLT_totaldeacertos')
-                cvlt_z = (cvlt_scaled - cvlt_pss) / regression_models['CVLT_totaldeacertos']['residual_sd']
-                percentile = norm.cdf(cvlt_z) * 100
-                _, _, classification, _, color = interpret_percentile(percentile)
-                
-                st.write(f"**{cvlt_name}**")
-                st.write(f"Z-score: {cvlt_z:.2f}")
-                st.write(f"Percentil: {percentile:.1f}%")
-                st.write(f"Classificação: {classification}")
-    
-                fig_cvlt = plot_normal_distribution(cvlt_z, 'CVLT_totaldeacertos', cvlt_name, percentile, classification, color)
-                st.pyplot(fig_cvlt)
-    
-                z_scores.append(cvlt_z)
-                report_data.append((cvlt_name, cvlt_z, percentile, fig_cvlt, classification))
+    # Set below when this run shows a generated report (or the no-tests warning)
+    st.session_state["report_shown"] = False
 
-    # Process BVMT
-    st.write("---")  # Add a line before each test
-    st.write(f"### {bvmt_name}")
-    bvmt_not_applicable = st.checkbox("Não se aplica", key="bvmt_na")
-    if not bvmt_not_applicable:
-        bvmt_input_method = st.radio("Como deseja inserir a pontuação?", ["Deslizar", "Digite"], key="bvmt_input")
-        if bvmt_input_method == "Deslizar":
-            bvmt_raw = st.slider("Pontuação Total BVMT", min_value=0, max_value=36, value=20, step=1)
-        else:
-            bvmt_raw = st.number_input("Pontuação Total BVMT", min_value=0, max_value=36, value=20, step=1)
-
-        if bvmt_raw is not None:
-            bvmt_scaled = convert_to_scaled_score(bvmt_raw, 'BVMT_Total')
-            if not np.isnan(bvmt_scaled):
-                bvmt_pss = calculate_predicted_scaled_score(age, sex, education, 'BVMT_Total')
-                bvmt_z = (bvmt_scaled - bvmt_pss) / regression_models['BVMT_Total']['residual_sd']
-                percentile = norm.cdf(bvmt_z) * 100
-                _, _, classification, _, color = interpret_percentile(percentile)
-                
-                st.write(f"**{bvmt_name}**")
-                st.write(f"Z-score: {bvmt_z:.2f}")
-                st.write(f"Percentil: {percentile:.1f}%")
-                st.write(f"Classificação: {classification}")
-    
-                fig_bvmt = plot_normal_distribution(bvmt_z, 'BVMT_Total', bvmt_name, percentile, classification, color)
-                st.pyplot(fig_bvmt)
-    
-                z_scores.append(bvmt_z)
-                report_data.append((bvmt_name, bvmt_z, percentile, fig_bvmt, classification))
+    # Process each test in display order; each section stores its report entry in session state
+    for measure, name, key, score_label, default_score in measure_inputs:
+        render_measure_section(measure, name, key, score_label, default_score, age, sex, education)
 
+    report_data = [st.session_state[f"{key}_result"] for _, _, key, _, _ in measure_inputs
+                   if st.session_state.get(f"{key}_result") is not None]
 
     if st.button("Salvar Relatório como PDF"):
+        st.session_state["report_shown"] = True
         if report_data:
-            temp_pdf_path, file_name = save_report_as_pdf(report_data, patient_name, sex, age, education, test_date)
-            with open(temp_pdf_path, "rb") as f:
-                st.download_button(label="Baixar Relatório PDF", data=f, file_name=file_name, mime="application/pdf")
-            os.remove(temp_pdf_path)
+            pdf_bytes, file_name = save_report_as_pdf(report_data, patient_name, sex, age, education, test_date)
+            st.download_button(label="Baixar Relatório PDF", data=pdf_bytes, file_name=file_name, mime="application/pdf")
         else:
             st.warning("Nenhum teste foi realizado.")
 